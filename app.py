@@ -1,26 +1,169 @@
 import streamlit as st
 import pandas as pd
 import gspread
+from gspread.utils import rowcol_to_a1
 import google.generativeai as genai
 from google.oauth2.service_account import Credentials
 from docx import Document
+from docx.oxml import parse_xml
+from lxml import etree
+from xml.sax.saxutils import escape
 from datetime import datetime, timedelta
 import json
 import io
+import re
 import zipfile 
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+import random
+import time
+import threading
+from google.api_core import exceptions as google_exceptions
 
 # 1. SETUP & PAGE CONFIG
 st.set_page_config(page_title="Coaching Generator", page_icon="🏆", layout="wide")
 
+MAX_CONCURRENT_REQUESTS = 8  # Max Gemini calls in flight at once
+MAX_RETRIES = 3  # Attempts per Gemini call before giving up
+TOKENS_PER_MINUTE = 250_000  # Gemini free-tier TPM for flash models; raise this on a paid tier
+MAX_OUTPUT_TOKENS = 4096  # Per-plan output cap; leaves headroom for thinking models
+MAX_BATCH_OUTPUT_TOKENS = 8192  # Output cap for one multi-agent prompt (the 8k limit of older flash models)
+MAX_AGENTS_PER_PROMPT = 5  # Upper bound on agents sharing one Gemini call
+# Every agent in a shared prompt gets the same output budget as a single-agent call
+AGENTS_PER_PROMPT = min(MAX_AGENTS_PER_PROMPT, MAX_BATCH_OUTPUT_TOKENS // MAX_OUTPUT_TOKENS)
+SMALL_BATCH_SIZE = 15  # Batches up to this size share prompts; bigger ones go one agent per call
+
 # --- 🧹 JANITOR FUNCTION ---
+JUNK_RE = re.compile(r"""\*\*|\['|'\]|\["|"\]""")
+
 def clean_text(text):
     """Handles lists, removes brackets, quotes, and markdown asterisks."""
     if isinstance(text, list):
-        text = "\n".join([str(item) for item in text])
-    text = str(text)
-    for junk in ["**", "['", "']", '["', '"]']:
-        text = text.replace(junk, "")
-    return text.strip()
+        text = "\n".join(map(str, text))
+    return JUNK_RE.sub("", str(text)).strip()
+
+# --- 🏷️ TEMPLATE TAGS ---
+# Template placeholder -> key in the Gemini JSON output
+AI_FIELDS = {
+    "{{Primary Focus}}": "primary_focus",
+    "{{Why Matters}}": "why_matters",
+    "{{Action Plan}}": "action_plan",
+    "{{Impact}}": "impact_question",
+    "{{Essential Habit}}": "essential_habit",
+    "{{Essential Habit Performed}}": "essential_habit_performed",
+    "{{Issue 1}}": "issue_1", "{{Comment 1}}": "comment_1", "{{Fix 1}}": "fix_1",
+    "{{Issue 2}}": "issue_2", "{{Comment 2}}": "comment_2", "{{Fix 2}}": "fix_2",
+    "{{Issue 3}}": "issue_3", "{{Comment 3}}": "comment_3", "{{Fix 3}}": "fix_3",
+    "{{Root Cause}}": "likely_root_cause", "{{Root Questions}}": "root_cause_questions", "{{Final Thoughts}}": "final_thoughts",
+}
+TEMPLATE_TAGS = ["{{Agent Name}}", "{{Date}}", "{{End Date}}", "{{Follow Up Date}}", *AI_FIELDS]
+TAG_RE = re.compile("|".join(re.escape(tag) for tag in TEMPLATE_TAGS))
+
+# --- 🧠 PROMPT ---
+# Static parts of the coaching prompt; only the INPUT DATA block changes per agent
+PROMPT_HEADER = """You are Khori, an expert QA Coach.
+INPUT DATA:"""
+
+PROMPT_FOOTER = """TASK: Output JSON following these strict rules:
+1. **Issues:** Identify 3 DISTINCT and DIFFERENT critical issues from MISSED OPPORTUNITIES.
+2. **Trend Identification:** Analyze the data to find a pattern. Do not just list random errors; identify the specific "Stimulus" (trigger) that causes the agent's performance to break down. Find the common thread for each. Do not repeat the same behavior or trend for multiple issues.
+3. **Behavior Syntax (CRITICAL):** For the "issue" fields, you MUST strictly follow this format: "Whenever <STIMULI>, <SYMPTOM> by <ACTION>". 
+    - <STIMULI>: The situation/trigger (e.g., "the customer is in a hurry").
+    - <SYMPTOM>: The high-level failure (e.g., "lack of urgency").
+    - <ACTION>: The observable behavior (e.g., "ignoring cues and reading the full script slowly").
+4. **Sort:** Sort by severity: AF > Total Resolution > Professionalism > Sincerity.
+5. **Primary Focus:** MUST be the most critical issue (Issue 1) based on the identified trend, create a high-level summary title (Category) that describes the main area of improvement (e.g., "Resolution Accuracy," "Engagement & Tone," or "Process Efficiency"). Do NOT just copy Issue 1.
+6. **Tone:** SIMPLE, DIRECT, CONVERSATIONAL. No big words.
+7. **Quick Fixes:** Provide a short, simple corrective sentence for each issue.
+8. **Habits:** Map "Missed" to Reference List (Essential Habit). Map "Strength" to Reference List (Essential Habit Performed).
+9. **Constraints:** - 'action_plan' must be under 245 characters.
+    - 'impact_question' must be under 245 characters.
+    - Do NOT use markdown asterisks (**) or bracket in any of the output text. Keep it clean.
+
+OUTPUT JSON KEYS:
+{
+  "primary_focus": "Same as Issue 1 name. A high-level category title summarizing the main trend.",
+  "why_matters": "Importance of fixing this trend.",
+  "action_plan": "SMART plan (Max 245 chars).",
+  "impact_question": "A question to help the agent self-reflect, followed by your insight on how improving this behavior will have a positive impact on their KPIs and the customer experience. (Max 245 chars).",
+  "essential_habit": "From Reference List (Matches Issue 1).",
+  "essential_habit_performed": "From Reference List (Matches Strength).",
+  "likely_root_cause": "The underlying skill or will gap.",
+  "root_cause_questions": "3 questions to ask the agent.",
+  "final_thoughts": "Closing encouragement from coach to agent.",
+  "issue_1": "Whenever <STIMULI>, <SYMPTOM> by <ACTION>", 
+  "comment_1": "A professional coach's insight analyzing the behavior. Do NOT repeat the problem; provide unique insight into why this behavior is detrimental to the customer experience.", 
+  "fix_1": "Simple fix.",
+  "issue_2": "Whenever <STIMULI>, <SYMPTOM> by <ACTION>", 
+  "comment_2": "A professional coach's insight analyzing the behavior. Do NOT repeat the problem; provide unique insight into why this behavior is detrimental to the customer experience.", 
+  "fix_2": "Simple fix.",
+  "issue_3": "Whenever <STIMULI>, <SYMPTOM> by <ACTION>", 
+  "comment_3": "A professional coach's insight analyzing the behavior. Do NOT repeat the problem; provide unique insight into why this behavior is detrimental to the customer experience.", 
+  "fix_3": "Simple fix."
+}
+
+REFERENCE LIST (Use EXACTLY):
+- Establish Credibility - Listen to the needs
+- Establish Credibility - Demonstrate common courtesy
+- Establish Credibility - Choose Language to optimize compression
+- Ask Insightful Questions - Ask Insightful Questions
+- Ask Insightful Questions - Informative and Persuasive Language
+- Ask Insightful Questions - Verbal Matching
+- Make Things Easy - Vocal Delivery
+- Make Things Easy - Manage discussions
+- Make Things Easy - Minimize Future effort
+- Be Present - Responding Immediately
+- Be Present - Demonstrate Understanding
+- Be Present - Provide Personalized responses
+- Communicate Optimism - Taking responsibility
+- Communicate Optimism - Framing optimistically
+- Communicate Optimism - Focusing on what can be done
+- Build Rapport - Respond to disclosures
+- Build Rapport - Engage in small talk
+- Build Rapport - Protect and promote self-image"""
+
+BATCH_PROMPT_NOTE = """Apply the TASK below to EACH agent in INPUT DATA separately. Never mix one agent's data into another agent's plan.
+Return a JSON array with one object per agent, in the same order. Each object has an "agent" key set to the agent name exactly as given, plus all the OUTPUT JSON KEYS."""
+
+def input_block(missed, strengths):
+    return f"\"MISSED OPPORTUNITIES\": {' || '.join(missed)}\n\"STRENGTHS\": {' || '.join(strengths)}"
+
+def build_prompt(missed, strengths):
+    """Single-agent prompt: static header and footer around this agent's data."""
+    return f"{PROMPT_HEADER}\n{input_block(missed, strengths)}\n\n{PROMPT_FOOTER}"
+
+def build_batch_prompt(agent_inputs):
+    """Multi-agent prompt: one labelled input block per (agent, missed, strengths)."""
+    blocks = "\n\n".join(f"\"AGENT\": {agent}\n{input_block(missed, strengths)}" for agent, missed, strengths in agent_inputs)
+    return f"{PROMPT_HEADER}\n{blocks}\n\n{BATCH_PROMPT_NOTE}\n\n{PROMPT_FOOTER}"
+
+# Structured output: Gemini returns valid JSON with exactly these string fields
+RESPONSE_SCHEMA = genai.protos.Schema(
+    type=genai.protos.Type.OBJECT,
+    properties={key: genai.protos.Schema(type=genai.protos.Type.STRING) for key in AI_FIELDS.values()},
+    required=list(AI_FIELDS.values()),
+)
+GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=RESPONSE_SCHEMA,
+    max_output_tokens=MAX_OUTPUT_TOKENS,
+    temperature=0.3,
+)
+BATCH_RESPONSE_SCHEMA = genai.protos.Schema(
+    type=genai.protos.Type.ARRAY,
+    items=genai.protos.Schema(
+        type=genai.protos.Type.OBJECT,
+        properties={key: genai.protos.Schema(type=genai.protos.Type.STRING) for key in ["agent", *AI_FIELDS.values()]},
+        required=["agent", *AI_FIELDS.values()],
+    ),
+)
+BATCH_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=BATCH_RESPONSE_SCHEMA,
+    max_output_tokens=AGENTS_PER_PROMPT * MAX_OUTPUT_TOKENS,
+    temperature=0.3,
+)
 
 # --- 🔒 PASSWORD PROTECTION ---
 if "APP_PASSWORD" in st.secrets:
@@ -47,22 +190,68 @@ if 'generated_files' not in st.session_state:
     st.session_state.generated_files = []
 if 'batch_complete' not in st.session_state:
     st.session_state.batch_complete = False
+if 'failed_agents' not in st.session_state:
+    st.session_state.failed_agents = []
+if 'team_grid_version' not in st.session_state:
+    st.session_state.team_grid_version = 0
+if 'team_dates' not in st.session_state:
+    st.session_state.team_dates = {}
+if 'search_dates' not in st.session_state:
+    st.session_state.search_dates = {}
 
 # --- 🔄 SELECT ALL CALLBACK ---
 def toggle_all():
-    """Forces all team checkboxes to match the 'Select All' state."""
+    """Resets the team grid so every row picks up the 'Select All' state."""
     st.session_state.batch_complete = False
-    for agent in MY_TEAM:
-        st.session_state[f"check_{agent}"] = st.session_state.select_all_team
+    # A new key is the only way to make the browser drop the grid's per-row edits
+    st.session_state.team_grid_version += 1
+
+# --- 🗓️ AGENT GRID ---
+def agent_grid(agents, key, dates, selected=False, lock_selection=False):
+    """Renders one editable Select/Agent/Date grid and returns the chosen (agent, date) pairs.
+
+    Grid edits are tracked by row position and dropped whenever the rows change, so the
+    dates a user picks are kept in `dates` (agent -> date) and used to seed the grid.
+    """
+    grid = pd.DataFrame({
+        "Select": [selected] * len(agents),
+        "Agent": agents,
+        "Date": [dates.get(agent, sidebar_date) for agent in agents],
+    })
+    edited = st.data_editor(
+        grid,
+        key=key,
+        hide_index=True,
+        width="stretch",
+        disabled=["Select", "Agent"] if lock_selection else ["Agent"],
+        column_config={
+            "Select": st.column_config.CheckboxColumn("Select", width="small"),
+            "Agent": st.column_config.TextColumn("Agent"),
+            "Date": st.column_config.DateColumn("Coaching Date", format="MM/DD/YYYY"),
+        },
+    )
+    for agent, seeded, picked in zip(agents, grid["Date"], edited["Date"]):
+        if pd.isna(picked):
+            dates.pop(agent, None)
+        elif picked != seeded:
+            dates[agent] = picked
+    return [
+        (row.Agent, sidebar_date if pd.isna(row.Date) else row.Date)
+        for row in edited.itertuples(index=False) if row.Select
+    ]
 
 # 2. AUTHENTICATION
-try:
+@st.cache_resource
+def get_gc():
     creds_info = st.secrets["GAA_JSON"]
     creds = Credentials.from_service_account_info(creds_info, scopes=[
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive"
     ])
-    gc = gspread.authorize(creds)
+    return gspread.authorize(creds)
+
+try:
+    get_gc()
     genai.configure(api_key=st.secrets["GEMINI_KEY"])
 except Exception as e:
     st.error(f"Authentication Error: {e}")
@@ -81,10 +270,65 @@ def get_valid_gemini_model():
         return 'models/gemini-1.5-flash'
 
 active_model_name = get_valid_gemini_model()
-model = genai.GenerativeModel(active_model_name)
+model = genai.GenerativeModel(active_model_name, generation_config=GENERATION_CONFIG)
 st.sidebar.success(f"🤖 Connected")
 #st.sidebar.success(f"🤖 Connected to: {active_model_name}")
 
+# --- 🔁 RETRY & RATE LIMIT ---
+RETRY_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.ServerError)
+
+@st.cache_resource
+def get_token_budget():
+    """Per-minute token window shared by every rerun and session, like the API quota itself."""
+    return {"window_start": time.monotonic(), "used": 0, "lock": threading.Lock()}
+
+async def wait_for_token_budget(tokens):
+    """Sleeps until the current minute has room to reserve `tokens`."""
+    budget = get_token_budget()
+    while True:
+        with budget["lock"]:
+            elapsed = time.monotonic() - budget["window_start"]
+            if elapsed >= 60:
+                budget["window_start"] = time.monotonic()
+                budget["used"] = 0
+                elapsed = 0
+            if budget["used"] == 0 or budget["used"] + tokens <= TOKENS_PER_MINUTE:
+                budget["used"] += tokens
+                return
+        # Recheck often: settled calls usually hand back most of their reservation
+        await asyncio.sleep(min(1, 60 - elapsed))
+
+def settle_token_budget(reserved, used):
+    """Swaps a call's reservation for what it actually used."""
+    budget = get_token_budget()
+    with budget["lock"]:
+        budget["used"] = max(0, budget["used"] - reserved + used)
+
+async def call_with_retry(prompt, semaphore, generation_config=None, tries=MAX_RETRIES):
+    """Calls Gemini, backing off exponentially on rate limits and server errors.
+
+    Each attempt reserves the prompt estimate plus the output cap before taking a
+    semaphore slot, so waiting on the budget or backing off never blocks other calls.
+    """
+    max_output = (generation_config or GENERATION_CONFIG).max_output_tokens
+    reserved = len(prompt) // 4 + max_output  # Rough chars-per-token estimate plus the worst-case reply
+    for attempt in range(tries):
+        await wait_for_token_budget(reserved)
+        try:
+            async with semaphore:
+                response = await model.generate_content_async(prompt, generation_config=generation_config)
+        except RETRY_ERRORS:
+            if attempt == tries - 1:
+                raise
+            await asyncio.sleep(2 ** attempt + random.uniform(0, 0.5))
+            continue
+        settle_token_budget(reserved, response.usage_metadata.total_token_count)
+        return response
+
+def hit_output_cap(response):
+    """True when Gemini stopped because it ran out of output tokens, i.e. the JSON is cut off."""
+    return bool(response.candidates) and response.candidates[0].finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS
+
 # 4. CONFIGURATION SIDEBAR
 with st.sidebar:
     st.header("Settings")
@@ -93,14 +337,96 @@ with st.sidebar:
     sidebar_date = st.date_input("Global Coaching Date", datetime.today())
     limit = st.number_input("Lookback Rows", value=5, min_value=1)
 
+# --- 📄 SHEET LOADER ---
+def column_ranges(col_numbers):
+    """Groups sorted 1-based column numbers into contiguous A1 ranges like 'G:J'."""
+    ranges = []
+    start = prev = col_numbers[0]
+    for col in col_numbers[1:] + [None]:
+        if col != prev + 1:
+            first, last = rowcol_to_a1(1, start)[:-1], rowcol_to_a1(1, prev)[:-1]
+            ranges.append(f"{first}:{last}")
+            start = col
+        prev = col
+    return ranges
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_sheet(sheet_url):
+    """Reads the name, Missed and Strength columns of the first worksheet into a DataFrame.
+
+    Cached so reruns skip the network; only the needed columns are downloaded.
+    """
+    worksheet = get_gc().open_by_url(sheet_url).get_worksheet(0)
+    headers = worksheet.row_values(1)
+    if "ES Last Name, First Name" not in headers:
+        return pd.DataFrame(columns=headers)
+
+    wanted = [
+        i for i, header in enumerate(headers, start=1)
+        if header == "ES Last Name, First Name" or "Skill Performance Area Missed" in header or "Strength" in header
+    ]
+    value_ranges = worksheet.batch_get(column_ranges(wanted), major_dimension="COLUMNS")
+    columns = [col for value_range in value_ranges for col in value_range]
+
+    # The API trims trailing blanks per column, so pad everything back to the same height
+    n_rows = max(len(col) for col in columns)
+    data = [list(row) for row in zip(*(col + [""] * (n_rows - len(col)) for col in columns))]
+    headers = data.pop(0)
+    return pd.DataFrame(data, columns=headers)
+
+def non_empty_cells(frame):
+    """Flattens a block of cells column by column, dropping blanks."""
+    values = frame.to_numpy().ravel(order="F")
+    return values[values.astype(bool)].tolist()
+
+# --- 📝 TEMPLATE LOADER ---
+@st.cache_resource
+def load_template_bytes(path):
+    """Reads the .docx template from disk once; each plan parses its own copy."""
+    with open(path, "rb") as f:
+        return f.read()
+
+LINE_BREAK_XML = '</w:t><w:br/><w:t xml:space="preserve">'
+
+def fill_template(doc, values):
+    """Swaps every tag in the document body in one regex pass over its XML."""
+    body = doc.element.body
+    xml_values = {tag: escape(val).replace("\n", LINE_BREAK_XML) for tag, val in values.items()}
+    xml = TAG_RE.sub(lambda m: xml_values[m.group(0)], etree.tostring(body, encoding="unicode"))
+    doc.element.replace(body, parse_xml(xml))
+    # Tags split across runs never match the raw XML; fall back to paragraph text for those
+    if "{{" in xml:
+        for p in doc.paragraphs:
+            text = p.text
+            if "{{" not in text:
+                continue
+            new_text = TAG_RE.sub(lambda m: values[m.group(0)], text)
+            if new_text != text:
+                p.text = new_text
+
+def build_doc(agent, final_date, ai_data, template_bytes):
+    """Fills one coaching plan from the template and returns it as a download entry."""
+    end_date = final_date + timedelta(days=21)
+    f_up = final_date + timedelta(days=7)
+    doc = Document(io.BytesIO(template_bytes))
+
+    replacements = {
+        "{{Agent Name}}": agent,
+        "{{Date}}": final_date.strftime("%m/%d/%Y"),
+        "{{End Date}}": end_date.strftime("%m/%d/%Y"),
+        "{{Follow Up Date}}": f_up.strftime("%m/%d/%Y"),
+        **{tag: ai_data.get(key, '') for tag, key in AI_FIELDS.items()},
+    }
+    fill_template(doc, {tag: clean_text(val) for tag, val in replacements.items()})
+
+    bio = io.BytesIO()
+    doc.save(bio)
+    return {"name": f"Coaching Plan - {agent}.docx", "data": bio.getvalue()}
+
 # 5. CORE LOGIC
 if sheet_url:
     try:
-        sh = gc.open_by_url(sheet_url)
-        worksheet = sh.get_worksheet(0)
-        data = worksheet.get_all_values()
-        headers = data.pop(0)
-        df = pd.DataFrame(data, columns=headers)
+        df = load_sheet(sheet_url)
         
         if "ES Last Name, First Name" in df.columns:
             st.subheader("👥 Select Agents & Dates")
@@ -112,159 +438,112 @@ if sheet_url:
                 # Select All button
                 st.checkbox("Select All My Team", key="select_all_team", on_change=toggle_all)
                 st.divider()
-                
-                for agent in MY_TEAM:
-                    if agent in df["ES Last Name, First Name"].values:
-                        col_check, col_name, col_date = st.columns([0.5, 3, 2])
-                        with col_check:
-                            is_selected = st.checkbox("", key=f"check_{agent}")
-                        with col_name:
-                            st.markdown(f"**{agent}**")
-                        with col_date:
-                            agent_date = st.date_input(f"Date for {agent}", value=sidebar_date, key=f"date_{agent}", label_visibility="collapsed")
-                        
-                        if is_selected:
-                            selected_configs.append((agent, agent_date))
+
+                agent_names = set(df["ES Last Name, First Name"])
+                team_in_sheet = [agent for agent in MY_TEAM if agent in agent_names]
+                if team_in_sheet:
+                    selected_configs = agent_grid(
+                        team_in_sheet,
+                        f"team_editor_{st.session_state.team_grid_version}",
+                        st.session_state.team_dates,
+                        selected=st.session_state.select_all_team,
+                    )
             else:
                 all_names = sorted(df["ES Last Name, First Name"].unique())
                 search_selection = st.multiselect("Search for agents:", all_names)
                 if search_selection:
                     st.divider()
-                    for agent in search_selection:
-                        col_check, col_name, col_date = st.columns([0.5, 3, 2])
-                        with col_check:
-                            st.checkbox("", value=True, key=f"check_search_{agent}", disabled=True)
-                        with col_name:
-                            st.markdown(f"**{agent}**")
-                        with col_date:
-                            agent_date = st.date_input(f"Date for {agent}", value=sidebar_date, key=f"date_search_{agent}", label_visibility="collapsed")
-                        selected_configs.append((agent, agent_date))
+                    selected_configs = agent_grid(search_selection, "search_editor", st.session_state.search_dates, selected=True, lock_selection=True)
 
             # THE RUN BUTTON
             if selected_configs:
                 st.divider()
                 if st.button("⚡ Generate Plans", type="primary", use_container_width=True):
                     st.session_state.generated_files = []
+                    st.session_state.failed_agents = []
                     st.session_state.batch_complete = False
                     progress_bar = st.progress(0)
                     status_text = st.empty()
                     
-                    for i, (agent, final_date) in enumerate(selected_configs):
-                        status_text.text(f"⏳ Processing {agent}...")
-                        
+                    # One filter pass over the sheet, then one groupby over just the selected agents
+                    selected_dates = dict(selected_configs)
+                    selected_rows = df[df["ES Last Name, First Name"].isin(selected_dates)]
+                    missed_cols = [col for col in df.columns if "Skill Performance Area Missed" in col]
+                    strength_cols = [col for col in df.columns if "Strength" in col]
+                    template_bytes = load_template_bytes(template_path)
+
+                    def agent_input(agent, agent_rows):
                         # A. GET DATA
-                        agent_rows = df[df["ES Last Name, First Name"] == agent].tail(limit)
-                        missed = [str(val) for col in df.columns if "Skill Performance Area Missed" in col for val in agent_rows[col] if val]
-                        strengths = [str(val) for col in df.columns if "Strength" in col for val in agent_rows[col] if val]
-                        
-                        # B. AI GENERATION (RESTORED PROMPTS EXACTLY)
-                        prompt = f"""
-                        You are Khori, an expert QA Coach.
-                        INPUT DATA: 
-                        "MISSED OPPORTUNITIES": { ' || '.join(missed) }
-                        "STRENGTHS": { ' || '.join(strengths) }
-                        
-                        TASK: Output JSON following these strict rules:
-                        1. **Issues:** Identify 3 DISTINCT and DIFFERENT critical issues from MISSED OPPORTUNITIES.
-                        2. **Trend Identification:** Analyze the data to find a pattern. Do not just list random errors; identify the specific "Stimulus" (trigger) that causes the agent's performance to break down. Find the common thread for each. Do not repeat the same behavior or trend for multiple issues.
-                        3. **Behavior Syntax (CRITICAL):** For the "issue" fields, you MUST strictly follow this format: "Whenever <STIMULI>, <SYMPTOM> by <ACTION>". 
-                            - <STIMULI>: The situation/trigger (e.g., "the customer is in a hurry").
-                            - <SYMPTOM>: The high-level failure (e.g., "lack of urgency").
-                            - <ACTION>: The observable behavior (e.g., "ignoring cues and reading the full script slowly").
-                        4. **Sort:** Sort by severity: AF > Total Resolution > Professionalism > Sincerity.
-                        5. **Primary Focus:** MUST be the most critical issue (Issue 1) based on the identified trend, create a high-level summary title (Category) that describes the main area of improvement (e.g., "Resolution Accuracy," "Engagement & Tone," or "Process Efficiency"). Do NOT just copy Issue 1.
-                        6. **Tone:** SIMPLE, DIRECT, CONVERSATIONAL. No big words.
-                        7. **Quick Fixes:** Provide a short, simple corrective sentence for each issue.
-                        8. **Habits:** Map "Missed" to Reference List (Essential Habit). Map "Strength" to Reference List (Essential Habit Performed).
-                        9. **Constraints:** - 'action_plan' must be under 245 characters.
-                            - 'impact_question' must be under 245 characters.
-                            - Do NOT use markdown asterisks (**) or bracket in any of the output text. Keep it clean.
-                        
-                        OUTPUT JSON KEYS:
-                        {{
-                          "primary_focus": "Same as Issue 1 name. A high-level category title summarizing the main trend.",
-                          "why_matters": "Importance of fixing this trend.",
-                          "action_plan": "SMART plan (Max 245 chars).",
-                          "impact_question": "A question to help the agent self-reflect, followed by your insight on how improving this behavior will have a positive impact on their KPIs and the customer experience. (Max 245 chars).",
-                          "essential_habit": "From Reference List (Matches Issue 1).",
-                          "essential_habit_performed": "From Reference List (Matches Strength).",
-                          "likely_root_cause": "The underlying skill or will gap.",
-                          "root_cause_questions": "3 questions to ask the agent.",
-                          "final_thoughts": "Closing encouragement from coach to agent.",
-                          "issue_1": "Whenever <STIMULI>, <SYMPTOM> by <ACTION>", 
-                          "comment_1": "A professional coach's insight analyzing the behavior. Do NOT repeat the problem; provide unique insight into why this behavior is detrimental to the customer experience.", 
-                          "fix_1": "Simple fix.",
-                          "issue_2": "Whenever <STIMULI>, <SYMPTOM> by <ACTION>", 
-                          "comment_2": "A professional coach's insight analyzing the behavior. Do NOT repeat the problem; provide unique insight into why this behavior is detrimental to the customer experience.", 
-                          "fix_2": "Simple fix.",
-                          "issue_3": "Whenever <STIMULI>, <SYMPTOM> by <ACTION>", 
-                          "comment_3": "A professional coach's insight analyzing the behavior. Do NOT repeat the problem; provide unique insight into why this behavior is detrimental to the customer experience.", 
-                          "fix_3": "Simple fix."
-                        }}
-
-                        REFERENCE LIST (Use EXACTLY):
-                        - Establish Credibility - Listen to the needs
-                        - Establish Credibility - Demonstrate common courtesy
-                        - Establish Credibility - Choose Language to optimize compression
-                        - Ask Insightful Questions - Ask Insightful Questions
-                        - Ask Insightful Questions - Informative and Persuasive Language
-                        - Ask Insightful Questions - Verbal Matching
-                        - Make Things Easy - Vocal Delivery
-                        - Make Things Easy - Manage discussions
-                        - Make Things Easy - Minimize Future effort
-                        - Be Present - Responding Immediately
-                        - Be Present - Demonstrate Understanding
-                        - Be Present - Provide Personalized responses
-                        - Communicate Optimism - Taking responsibility
-                        - Communicate Optimism - Framing optimistically
-                        - Communicate Optimism - Focusing on what can be done
-                        - Build Rapport - Respond to disclosures
-                        - Build Rapport - Engage in small talk
-                        - Build Rapport - Protect and promote self-image
-                        """
-                        
-                        try:
-                            response = model.generate_content(prompt)
-                            clean_json = response.text.replace('```json', '').replace('```', '').strip()
-                            ai_data = json.loads(clean_json)
-                        except:
-                            ai_data = {}
-
-                        # C. CREATE DOC
-                        end_date = final_date + timedelta(days=21)
-                        f_up = final_date + timedelta(days=7)
-                        doc = Document(template_path)
-                        
-                        replacements = {
-                            "{{Agent Name}}": agent,
-                            "{{Date}}": final_date.strftime("%m/%d/%Y"),
-                            "{{End Date}}": end_date.strftime("%m/%d/%Y"),
-                            "{{Follow Up Date}}": f_up.strftime("%m/%d/%Y"),
-                            "{{Primary Focus}}": ai_data.get('primary_focus', ''),
-                            "{{Why Matters}}": ai_data.get('why_matters', ''),
-                            "{{Action Plan}}": ai_data.get('action_plan', ''),
-                            "{{Impact}}": ai_data.get('impact_question', ''),
-                            "{{Essential Habit}}": ai_data.get('essential_habit', ''),
-                            "{{Essential Habit Performed}}": ai_data.get('essential_habit_performed', ''),
-                            "{{Issue 1}}": ai_data.get('issue_1', ''), "{{Comment 1}}": ai_data.get('comment_1', ''), "{{Fix 1}}": ai_data.get('fix_1', ''),
-                            "{{Issue 2}}": ai_data.get('issue_2', ''), "{{Comment 2}}": ai_data.get('comment_2', ''), "{{Fix 2}}": ai_data.get('fix_2', ''),
-                            "{{Issue 3}}": ai_data.get('issue_3', ''), "{{Comment 3}}": ai_data.get('comment_3', ''), "{{Fix 3}}": ai_data.get('fix_3', ''),
-                            "{{Root Cause}}": ai_data.get('likely_root_cause', ''), "{{Root Questions}}": ai_data.get('root_cause_questions', ''), "{{Final Thoughts}}": ai_data.get('final_thoughts', '')
-                        }
-
-                        for p in doc.paragraphs:
-                            for tag, val in replacements.items():
-                                if tag in p.text:
-                                    p.text = p.text.replace(tag, clean_text(val))
-                        
-                        # D. SAVE TO MEMORY
-                        bio = io.BytesIO()
-                        doc.save(bio)
-                        bio.seek(0)
-                        
-                        file_name = f"Coaching Plan - {agent}.docx"
-                        st.session_state.generated_files.append({"name": file_name, "data": bio})
-                        progress_bar.progress((i + 1) / len(selected_configs))
+                        agent_rows = agent_rows.tail(limit)
+                        return agent, non_empty_cells(agent_rows[missed_cols]), non_empty_cells(agent_rows[strength_cols])
+
+                    async def process_agent(agent, missed, strengths, semaphore, executor, ai_data=None):
+                        # B. AI GENERATION (skipped when a batched prompt already produced this plan)
+                        failure = "empty response"
+                        if not ai_data:
+                            try:
+                                status_text.text(f"⏳ Processing {agent}...")
+                                response = await call_with_retry(build_prompt(missed, strengths), semaphore)
+                                ai_data = json.loads(response.text)
+                            except Exception as e:
+                                ai_data = {}
+                                failure = type(e).__name__
+
+                        # Nothing to fill in, so don't hand the user an empty plan
+                        if not ai_data:
+                            st.session_state.failed_agents.append((agent, failure))
+                            return None
+
+                        # C. CREATE DOC (on a worker thread so the event loop keeps serving Gemini calls)
+                        loop = asyncio.get_running_loop()
+                        return await loop.run_in_executor(executor, build_doc, agent, selected_dates[agent], ai_data, template_bytes)
+
+                    async def process_chunk(chunk, semaphore, executor):
+                        # One Gemini call for the whole chunk. A truncated or unparseable reply, or an agent
+                        # missing from it, falls back to single-agent prompts; API errors fail the whole chunk
+                        plans = {}
+                        if len(chunk) > 1:
+                            try:
+                                status_text.text(f"⏳ Processing {', '.join(agent for agent, _, _ in chunk)}...")
+                                response = await call_with_retry(build_batch_prompt(chunk), semaphore, generation_config=BATCH_GENERATION_CONFIG)
+                            except google_exceptions.GoogleAPIError as e:
+                                # Retries are spent (or the call can't succeed); more calls would only add load
+                                st.session_state.failed_agents.extend((agent, type(e).__name__) for agent, _, _ in chunk)
+                                return [None] * len(chunk)
+                            if not hit_output_cap(response):
+                                try:
+                                    plans = {plan.get("agent"): plan for plan in json.loads(response.text)}
+                                except (ValueError, TypeError, AttributeError):
+                                    plans = {}
+                        return await asyncio.gather(*(
+                            process_agent(agent, missed, strengths, semaphore, executor, ai_data=plans.get(agent))
+                            for agent, missed, strengths in chunk
+                        ))
+
+                    async def run_batch(executor):
+                        # Gemini calls are I/O bound, so fan them out and cap how many are in flight
+                        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+                        agent_inputs = [
+                            agent_input(agent, agent_rows)
+                            for agent, agent_rows in selected_rows.groupby("ES Last Name, First Name", sort=False)
+                        ]
+                        # Small batches share prompts to save round trips; large ones already saturate the semaphore
+                        chunk_size = AGENTS_PER_PROMPT if len(agent_inputs) <= SMALL_BATCH_SIZE else 1
+                        tasks = [
+                            process_chunk(agent_inputs[start:start + chunk_size], semaphore, executor)
+                            for start in range(0, len(agent_inputs), chunk_size)
+                        ]
+                        done = 0
+                        for task in asyncio.as_completed(tasks):
+                            results = await task
+                            st.session_state.generated_files.extend(result for result in results if result)
+                            done += len(results)
+                            progress_bar.progress(done / len(agent_inputs))
+
+                    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                        asyncio.run(run_batch(executor))
+                    # Results arrive in completion order; keep the download list alphabetical
+                    st.session_state.generated_files.sort(key=lambda f: f["name"])
                     
                     st.session_state.batch_complete = True
                     status_text.text("✅ All Done!")
@@ -272,14 +551,19 @@ if sheet_url:
             # ---------------------------------------------------------
             # ⬇️ DOWNLOAD SECTION
             # ---------------------------------------------------------
+            if st.session_state.batch_complete and st.session_state.failed_agents:
+                failures = ", ".join(f"{agent} ({reason})" for agent, reason in sorted(st.session_state.failed_agents))
+                st.warning(f"⚠️ Failed: {failures}")
+
             if st.session_state.batch_complete and st.session_state.generated_files:
                 st.success("Analysis Complete! Download your files below.")
                 st.markdown("---")
                 
                 zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, "w") as zf:
+                # .docx files are already deflated, so store them as-is
+                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zf:
                     for f in st.session_state.generated_files:
-                        zf.writestr(f["name"], f["data"].getvalue())
+                        zf.writestr(f["name"], f["data"])
                 
                 st.download_button(
                     label="📦 Download ALL (ZIP)",